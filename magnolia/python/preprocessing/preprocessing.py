@@ -6,7 +6,7 @@ import h5py
 import numpy as np
 # import soundfile as sf
 from tqdm import tqdm
-from scipy.signal import resample_poly
+from scipy.signal import resample_poly, lfilter
 # from python_speech_features.sigproc import preemphasis
 import librosa as lr
 from .spectral_features import stft, istft
@@ -45,28 +45,20 @@ def undo_preemphasis(preemphasized_signal, coeff=0.95):
     with p(0) = s(0).  The inverse operation constructs the signal from the
     preemphasized signal with the recursion relation
                     s(n) = p(n) + coeff*s(n-1)
+    which is applied as an IIR filter along the last axis, so a stack of
+    signals (e.g. sources x time) can be processed with a single call.
     Inputs:
-        preemphasized_signal:  numpy array containing preemphasised signal
+        preemphasized_signal:  numpy array containing preemphasised signal(s)
         coeff:   coefficient used to compute the preemphasized signal
     Returns:
-        signal: numpy array containing the signal without preemphasis
+        signal: numpy array containing the signal(s) without preemphasis
     """
 
     if coeff == 0.0:
         return preemphasized_signal
 
-    # Get the length of the input and preallocate the output array
-    length = preemphasized_signal.shape[0]
-    signal = np.zeros(length)
-
-    # Set the initial element of the signal
-    signal[0] = preemphasized_signal[0]
-
     # Use the recursion relation to compute the output signal
-    for i in range(1, length):
-        signal[i] = preemphasized_signal[i] + coeff*signal[i-1]
-
-    return signal
+    return lfilter([1.0], [1.0, -coeff], preemphasized_signal, axis=-1)
 
 
 def preprocess_waveform(y, sample_rate,
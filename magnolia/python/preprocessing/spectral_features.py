@@ -6,6 +6,7 @@ reconstructing time-domain audio signals from spectral features
 
 import sys
 import logging
+import functools
 import numpy as np
 import scipy.signal
 
@@ -35,43 +36,120 @@ def stft(x, fs, framesz, hop, two_sided=True, fft_size=None):
     return X.T
 
 
+@functools.lru_cache(maxsize=None)
+def _hann_window(framesamp):
+    """Periodic Hann window (as used by scipy.signal.stft) of length framesamp
+
+    The separation pipelines only ever use a couple of fixed frame sizes, so
+    the window is computed once per size and shared (read-only) between calls.
+    """
+
+    window = scipy.signal.get_window('hann', framesamp)
+    window.setflags(write=False)
+    return window
+
+
+def _overlap_add(frames, hop):
+    """Overlap-add a set of frames spaced hop samples apart
+
+    Rather than looping over every frame, each frame is cut into hop-sized
+    chunks and the k-th chunk of all the frames is accumulated in a single
+    vectorized add, so the loop only runs ceil(frame_size/hop) times.
+
+    Input:
+        frames - array of frames, (...) x num_frames x frame_size
+        hop - number of samples between the starts of successive frames
+
+    Output:
+        x - array of overlap-added signal(s), (...) x
+            (frame_size + (num_frames - 1)*hop)
+    """
+
+    num_frames, frame_size = frames.shape[-2:]
+    num_chunks = -(-frame_size//hop)
+    batch_shape = frames.shape[:-2]
+
+    # Zero pad the frames to a whole number of chunks if necessary
+    if num_chunks*hop != frame_size:
+        padded = np.zeros(frames.shape[:-1] + (num_chunks*hop,),
+                          dtype=frames.dtype)
+        padded[..., :frame_size] = frames
+        frames = padded
+    chunks = frames.reshape(batch_shape + (num_frames, num_chunks, hop))
+
+    x = np.zeros(batch_shape + (num_frames + num_chunks - 1, hop),
+                 dtype=frames.dtype)
+    for k in range(num_chunks):
+        x[..., k:k + num_frames, :] += chunks[..., k, :]
+
+    x = x.reshape(batch_shape + (-1,))
+    return x[..., :frame_size + (num_frames - 1)*hop]
+
+
 def istft(X, fs, recon_size, hop, two_sided=True, fft_size=None):
     """Inverse Short Time Fourier Transform (iSTFT) - Spectral reconstruction
 
     Input:
-        X - set of 1D time-windowed spectra, time x frequency
+        X - set of 1D time-windowed spectra, time x frequency.  Any leading
+            dimensions (e.g. sources x time x frequency) are treated as a
+            batch and inverted in a single call
         fs - sampling frequency (in Hz)
         recon_size - Not used
         hop - skip rate between successive windows
         fft_size - number of DFT points
 
     Output:
-        x - a 1-D array holding reconstructed time-domain audio signal
+        x - an array holding reconstructed time-domain audio signal(s), with
+            the same leading dimensions as X
     """
 
     if two_sided:
-        framesamp = X.shape[1]
+        framesamp = X.shape[-1]
     else:
-        framesamp = 2*(X.shape[1] - 1)
+        framesamp = 2*(X.shape[-1] - 1)
     hopsamp = int(hop*fs)
-    overlap_samp = framesamp - hopsamp
+    if fft_size is None:
+        fft_size = framesamp
+    window = _hann_window(framesamp)
+
+    # Invert the DFT of every frame at once (irfft only needs the positive
+    # frequencies) and undo the window scaling applied by stft
+    if two_sided:
+        frames = np.fft.ifft(X, n=fft_size, axis=-1)[..., :framesamp]
+    else:
+        frames = np.fft.irfft(X, n=fft_size, axis=-1)[..., :framesamp]
+    frames *= window.sum()*window
+
+    # Overlap-add the frames, accumulating the squared window for the
+    # normalization
+    num_frames = X.shape[-2]
+    x = _overlap_add(frames, hopsamp)
+    norm = _overlap_add(np.broadcast_to(window**2, (num_frames, framesamp)),
+                        hopsamp)
+
+    # Remove the padding added by stft and divide out the window overlap
+    x = x[..., framesamp//2:-(framesamp//2)]
+    norm = norm[framesamp//2:-(framesamp//2)]
+    if np.any(norm <= 1e-10):
+        logger = logging.getLogger(__name__)
+        logger.warn("NOLA condition failed, STFT may not be invertible.")
+    x /= np.where(norm > 1e-10, norm, 1.0)
 
-    _, x = scipy.signal.istft(X.T, fs=fs, window='hann', nperseg=framesamp,
-        nfft=fft_size, noverlap = overlap_samp,
-        input_onesided=not two_sided)
-    if recon_size is not None and recon_size != x.shape[0]:
+    if recon_size is not None and recon_size != x.shape[-1]:
         logger = logging.getLogger(__name__)
         logger.warn("Size of reconstruction ({}) does not match value of "
-        "deprecated recon_size parameter ({}).".format(x.shape[0], recon_size))
+        "deprecated recon_size parameter ({}).".format(x.shape[-1], recon_size))
     return x
 
 
 def scale_spectrogram(spectrogram):
     mag_spec = np.abs(spectrogram)
-    phases = np.unwrap(np.angle(spectrogram))
+    phases = np.angle(spectrogram)
 
-    mag_spec = np.sqrt(mag_spec)
+    np.sqrt(mag_spec, out=mag_spec)
     M = mag_spec.max()
     m = mag_spec.min()
+    mag_spec -= m
+    mag_spec /= M - m
 
-    return (mag_spec - m)/(M - m), phases
+    return mag_spec, phases
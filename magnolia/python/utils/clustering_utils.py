@@ -4,8 +4,11 @@ domain vectors. Assumes that models have a get_vectors method which takes in an
 input and returns the T-F vectors for clustering.
 """
 
+import os
+from multiprocessing.pool import ThreadPool
 import numpy as np
-from sklearn.cluster import KMeans, SpectralClustering, AgglomerativeClustering
+from sklearn.cluster import KMeans, MiniBatchKMeans, SpectralClustering, \
+                           AgglomerativeClustering
 from sklearn.mixture import BayesianGaussianMixture, GaussianMixture
 from sklearn.decomposition import PCA
 
@@ -35,18 +38,20 @@ def preprocess_signal(signal, sample_rate):
         X_in: Scaled STFT input feature for the model
     """
 
-    # Compute the spectrogram of the signal
+    # Compute the spectrogram of the signal as 32 bit floats
     spectrogram = make_stft_features(signal, sample_rate)
+    spectrogram = spectrogram.astype(np.complex64, copy=False)
 
     # Get the magnitude spectrogram
-    mag_spec = np.abs(spectrogram)
+    X_in = np.abs(spectrogram)
 
     # Scale the magnitude spectrogram with a square root squashing, and percent
-    # normalization
-    X_in = np.sqrt(mag_spec)
+    # normalization (in place, to avoid a temporary for every step)
+    np.sqrt(X_in, out=X_in)
     m = X_in.min()
     M = X_in.max()
-    X_in = (X_in - m)/(M - m)
+    X_in -= m
+    X_in /= M - m
 
     return spectrogram, X_in
 
@@ -71,13 +76,14 @@ def process_signal(signal, sample_rate, model):
 
     # Reshape the input feature into the shape the model expects and compute
     # the embedding vectors
-    X_in = np.reshape(X_in, (1, X_in.shape[0], X_in.shape[1]))
+    X_in = X_in[np.newaxis, :, :]
     vectors = model.get_vectors(X_in)
 
     return spectrogram, vectors
 
 
-def get_cluster_masks(vectors, num_sources, binary_mask=True, algo=None):
+def get_cluster_masks(vectors, num_sources, binary_mask=True, algo=None,
+                      init_centers=None, return_centers=False):
     """
     Cluster the vectors using k-means with k=num_sources.  Use the cluster IDs
     to create num_sources T-F masks.
@@ -88,22 +94,43 @@ def get_cluster_masks(vectors, num_sources, binary_mask=True, algo=None):
         num_sources: Integer number of sources to compute masks for
         binary_mask: If true, computes binary masks.  Otherwise computes the
                      soft masks.
-        algo: sklearn-compatable clustering algorithm
+        algo: sklearn-compatable clustering algorithm (defaults to
+              mini-batch k-means)
+        init_centers: Optional numpy array of shape (num_sources, Embedding)
+                      used to warm start k-means, e.g. the centers returned
+                      for a previous segment.  If algo is also given it must
+                      be a k-means estimator; its init is replaced by these
+                      centers.
+        return_centers: If true, also return the cluster centers found so they
+                        can be passed back in as init_centers (k-means
+                        clusterers only)
 
     Returns:
          masks: Numpy array of shape (Time, Frequency, num_sources) containing
                 the estimated binary mask for each of the num_sources sources.
+         centers: (only if return_centers is true) Numpy array of shape
+                  (num_sources, Embedding) containing the cluster centers
     """
 
     if algo is None:
-        algo = KMeans(n_clusters=num_sources, random_state=0)
+        if init_centers is None:
+            algo = MiniBatchKMeans(n_clusters=num_sources, random_state=0,
+                                   batch_size=4096, n_init=3, max_iter=100)
+        else:
+            # Starting from known centers converges in a few iterations, so a
+            # single initialization is enough
+            algo = MiniBatchKMeans(n_clusters=num_sources, random_state=0,
+                                   batch_size=4096, init=init_centers,
+                                   n_init=1, max_iter=100)
+    elif init_centers is not None:
+        algo.set_params(init=init_centers, n_init=1)
 
     # Get the shape of the input
     shape = np.shape(vectors)
-    
-    # Preallocate mask array
-    masks = np.zeros((shape[1]*shape[2], num_sources))
-    
+
+    # One-hot lookup table used to turn cluster IDs into binary masks
+    one_hot = np.eye(num_sources, dtype=np.float32)
+
     if algo.__class__.__name__ == 'BayesianGaussianMixture' or algo.__class__.__name__ == 'GaussianMixture':
         vectors = PCA(n_components=max(1, shape[3]//10),
                       random_state=0).fit_transform(vectors[0].reshape((shape[1]*shape[2], shape[3])))
@@ -114,14 +141,9 @@ def get_cluster_masks(vectors, num_sources, binary_mask=True, algo=None):
         all_probs = algo.predict_proba(vectors)
         
         if binary_mask:
-            for i in range(all_probs.shape[0]):
-                probs = all_probs[i]
-                label = np.argmax(probs)
-                masks[i, label] = 1
+            masks = one_hot[np.argmax(all_probs, axis=1)]
         else:
-            for i in range(all_probs.shape[0]):
-                probs = all_probs[i]
-                masks[i, :] = probs/probs.sum()
+            masks = (all_probs/all_probs.sum(axis=1, keepdims=True)).astype(np.float32)
 
         masks = masks.reshape((shape[1], shape[2], num_sources))
 
@@ -131,21 +153,18 @@ def get_cluster_masks(vectors, num_sources, binary_mask=True, algo=None):
 
         if binary_mask:
             # Use cluster IDs to construct masks
-            labels = algo.labels_
-            for i in range(labels.shape[0]):
-                label = labels[i]
-                masks[i, label] = 1
+            masks = one_hot[algo.labels_]
 
             masks = masks.reshape((shape[1], shape[2], num_sources))
 
         else:
-            if algo.__class__.__name__ == 'KMeans':
+            if algo.__class__.__name__ in ('KMeans', 'MiniBatchKMeans'):
                 all_dists = algo.transform(vectors[0].reshape((shape[1]*shape[2],shape[3])))
-                for i in range(all_dists.shape[0]):
-                    dists = all_dists[i]
-                    masks[i, :] = dists/dists.sum()
+                masks = (all_dists/all_dists.sum(axis=1, keepdims=True)).astype(np.float32)
 
                 masks = masks.reshape((shape[1], shape[2], num_sources))
+            else:
+                masks = np.zeros((shape[1]*shape[2], num_sources), dtype=np.float32)
             # # Get cluster centers
             # centers = algo.cluster_centers_
             # centers = centers.T
@@ -159,6 +178,9 @@ def get_cluster_masks(vectors, num_sources, binary_mask=True, algo=None):
             # masks = softmax(masks)
             # # masks = 1/(1 + np.exp(-masks))
 
+    if return_centers:
+        return masks, algo.cluster_centers_
+
     return masks
 
 def apply_masks(spectrogram, masks):
@@ -176,14 +198,13 @@ def apply_masks(spectrogram, masks):
         masked_spectrograms: Numpy array of shape (sources, T, F) containing
                              the masked complex spectrograms for each source.
     """
-    num_sources = masks.shape[2]
-
-    masked_specs = [masks[:,:,i]*spectrogram for i in range(num_sources)]
+    masked_specs = masks.transpose(2, 0, 1)*spectrogram
 
     return masked_specs
 
 def clustering_separate(signal, sample_rate, model, num_sources,
-                        binary_mask=True):
+                        binary_mask=True, algo=None, init_centers=None,
+                        return_centers=False):
     """
     Takes in a signal and a model which has a get_vectors method and returns
     the specified number of output sources.
@@ -195,9 +216,16 @@ def clustering_separate(signal, sample_rate, model, num_sources,
         num_sources: Integer number of sources to separate into
         binary_mask: If true, computes the binary mask. Otherwise
                      computes a soft mask
+        algo: sklearn-compatable clustering algorithm (see get_cluster_masks)
+        init_centers: Cluster centers to warm start k-means from when
+                      separating consecutive segments or files
+        return_centers: If true, also return the cluster centers found so they
+                        can be passed as init_centers for the next signal
 
     Returns:
         sources: Numpy ndarray of shape (num_sources, signal_length)
+        centers: (only if return_centers is true) Numpy array of shape
+                 (num_sources, Embedding) containing the cluster centers
     """
 
     # Get the T-F embedding vectors for this signal from the model
@@ -205,21 +233,69 @@ def clustering_separate(signal, sample_rate, model, num_sources,
 
     # Run k-means clustering on the vectors with k=num_sources to recover the
     # signal masks
-    masks = get_cluster_masks(vectors, num_sources, binary_mask=binary_mask)
+    if return_centers:
+        masks, centers = get_cluster_masks(vectors, num_sources,
+                                           binary_mask=binary_mask, algo=algo,
+                                           init_centers=init_centers,
+                                           return_centers=True)
+    else:
+        masks = get_cluster_masks(vectors, num_sources,
+                                  binary_mask=binary_mask, algo=algo,
+                                  init_centers=init_centers)
 
     # Apply the masks from the clustering to the input signal
     masked_specs = apply_masks(spectrogram, masks)
 
-    # Invert the STFT to recover the output waveforms, remembering to undo the
-    # preemphasis
-    waveforms = []
-    for i in range(num_sources):
-        waveform = istft(masked_specs[i], 1e4, None, 0.0256, two_sided=False,
-                         fft_size=512)
-        unemphasized = undo_preemphasis(waveform)
-        waveforms.append(unemphasized)
+    # Invert the STFT of all the sources at once to recover the output
+    # waveforms, remembering to undo the preemphasis
+    waveforms = istft(masked_specs, 1e4, None, 0.0256, two_sided=False,
+                      fft_size=512)
+
+    sources = undo_preemphasis(waveforms)
+
+    if return_centers:
+        return sources, centers
+
+    return sources
+
+
+def batch_clustering_separate(signals, sample_rate, model, num_sources,
+                              binary_mask=True, n_jobs=-1):
+    """
+    Runs clustering_separate on a list of signals in parallel.  The signals
+    are distributed over a pool of threads rather than processes, so the model
+    is shared instead of pickled for every worker; the numpy, scipy and
+    sklearn stages of the pipeline release the GIL.
+
+    Note that each thread's k-means and BLAS calls may start their own
+    OpenMP thread pool, so on machines with few cores it can pay to limit
+    those (e.g. OMP_NUM_THREADS=1) or use fewer workers.
+
+    Inputs:
+        signals: List of numpy 1D arrays containing the waveforms to separate
+        sample_rate: Sampling rate of the input signals
+        model: Instance of model to use to separate the signals
+        num_sources: Integer number of sources to separate each signal into
+        binary_mask: If true, computes the binary mask. Otherwise
+                     computes a soft mask
+        n_jobs: Number of worker threads.  Negative values are counted back
+                from the number of CPUs as in joblib, so -1 (the default)
+                uses all of them and -2 all but one.
+
+    Returns:
+        sources: List containing a numpy ndarray of shape
+                 (num_sources, signal_length) for each input signal
+    """
+
+    def separate(signal):
+        return clustering_separate(signal, sample_rate, model, num_sources,
+                                   binary_mask=binary_mask)
+
+    if n_jobs < 0:
+        n_jobs = max(1, (os.cpu_count() or 1) + 1 + n_jobs)
 
-    sources = np.stack(waveforms)
+    with ThreadPool(processes=n_jobs) as pool:
+        sources = pool.map(separate, signals)
 
     return sources
 
@@ -266,9 +342,7 @@ def l41_clustering_separate(spec, model, num_sources,
     masks = get_cluster_masks(vectors, num_sources, binary_mask=binary_mask, algo=clusterer)
 
     # Apply the masks from the clustering to the input signal
-    masked_specs = apply_masks(spec[0].T, masks)
-
-    sources = np.stack(masked_specs)
+    sources = apply_masks(spec[0].T, masks)
 
     return sources.transpose(0, 2, 1)
 
@@ -303,9 +377,7 @@ def chimera_clustering_separate(spec, model, num_sources,
     masks = get_cluster_masks(vectors, num_sources, binary_mask=binary_mask, algo=clusterer)
 
     # Apply the masks from the clustering to the input signal
-    masked_specs = apply_masks(spec[0].T, masks)
-
-    sources = np.stack(masked_specs)
+    sources = apply_masks(spec[0].T, masks)
 
     return sources.transpose(0, 2, 1)
 
@@ -349,9 +421,7 @@ def l41_regression_clustering_separate(spec, model, num_sources,
     masks = get_cluster_masks(vectors, num_sources, binary_mask=binary_mask, algo=clusterer)
 
     # Apply the masks from the clustering to the input signal
-    masked_specs = apply_masks(spec[0].T, masks)
-
-    sources = np.stack(masked_specs)
+    sources = apply_masks(spec[0].T, masks)
 
     return sources.transpose(0, 2, 1)
 
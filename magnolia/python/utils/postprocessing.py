@@ -33,7 +33,7 @@ def reconstruct(spec_mag, spec_full, fs, window_size, step_size, square=False,
     if spec_full is None:
         phase = np.random.randn(*spec_mag.shape)
     else:
-        phase = np.exp(1.0j*np.unwrap(np.angle(spec_full)))
+        phase = np.exp(1.0j*np.angle(spec_full))
 
     if square:
         mag = mag ** 2
@@ -15,17 +15,18 @@ def featurize_spectrogram(spectrogram):
     Takes in a spectrogram and outputs a normalized version for consumption by
     the model
     """
-    # Get the magnitude spectrogram and phases
-    X_input = np.abs(spectrogram)
-    phases = np.unwrap(np.angle(spectrogram))
+    # Get the magnitude spectrogram and the unit-magnitude phase factors
+    X_input = np.abs(spectrogram).astype(np.float32, copy=False)
+    phase_factor = np.exp(1.0j*np.angle(spectrogram))
 
-    # Normalize the magnitude spectrogram
-    X_input = np.sqrt(X_input)
+    # Normalize the magnitude spectrogram in place to avoid temporaries
+    np.sqrt(X_input, out=X_input)
     X_max = X_input.max()
     X_min = X_input.min()
-    X_input = (X_input - X_min)/(X_max - X_min)
+    X_input -= X_min
+    X_input /= X_max - X_min
 
-    return X_input, phases, X_max, X_min
+    return X_input, phase_factor, X_max, X_min
 
 def separate_sources(signal_path, model,
                      sample_rate=1e4, window_size=0.05, overlap=0.025):
@@ -42,18 +43,19 @@ def separate_sources(signal_path, model,
         sources: Numpy ndarray containing waveforms of separated sources
     """
 
-    # Read in the audio file
-    signal, rate = sf.read(signal_path)
+    # Read in the audio file, decoding directly to 32 bit floats
+    signal, rate = sf.read(signal_path, dtype='float32')
 
     # Get complex spectrogram
     spectrogram = make_stft_features(signal, rate,
                                      sample_rate, window_size, overlap, fft_size=500)
+    spectrogram = spectrogram.astype(np.complex64, copy=False)
 
     # Get model inputs
-    X_input, phases, X_max, X_min = featurize_spectrogram(spectrogram)
+    X_input, phase_factor, X_max, X_min = featurize_spectrogram(spectrogram)
 
     # Reshape the input to the form the model expects
-    X_input = np.reshape(X_input, (1,X_input.shape[0],X_input.shape[1],1))
+    X_input = X_input[np.newaxis, :, :, np.newaxis]
 
     # Get the model output for this input
     y_output = model.predict(X_input)
@@ -63,17 +65,18 @@ def separate_sources(signal_path, model,
     y_output = np.square(y_output)
 
     # Process these outputs back into waveforms
-    duration = 1/2*(spectrogram.shape[0] + 1)*window_size
-    source_list = []
-
-    for i in range(y_output.shape[3]):
-        complex_spectrogram = y_output[0,:,:,i]*np.exp(phases*1.0j)
-        waveform = istft(complex_spectrogram,
-                         sample_rate, None, overlap, two_sided=False,fft_size=500)
-        waveform = undo_preemphasis(waveform)
-        waveform = (waveform - waveform.mean())/waveform.std()
-        source_list.append(waveform)
-
-    sources = np.stack(source_list)
+    complex_spectrograms = y_output[0].transpose(2, 0, 1)*phase_factor
+    sources = istft(complex_spectrograms,
+                    sample_rate, None, overlap, two_sided=False,
+                    fft_size=500)
+
+    # Undo the preemphasis of each waveform in place in the (sources, length)
+    # array
+    for i in range(sources.shape[0]):
+        sources[i] = undo_preemphasis(sources[i])
+
+    # Normalize all of the waveforms at once
+    sources -= sources.mean(axis=1, keepdims=True)
+    sources /= sources.std(axis=1, keepdims=True)
 
     return sources
\ No newline at end of file